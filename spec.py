@@ -1,12 +1,15 @@
 from db import *
 
 # Core packages
-from math import fsum
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 import scipy.constants as cte
-from scipy.special import wofz,erf
+from scipy.special import wofz,erf,erfc,voigt_profile
 from scipy.optimize import curve_fit
-from scipy.signal import convolve
+from scipy.signal import fftconvolve,oaconvolve
+from scipy.fft import rfft,irfft,next_fast_len
 from scipy.interpolate import interp1d
+from scipy.ndimage import convolve1d
 
 # Astro-packages
 from astropy.time import Time
@@ -15,11 +18,22 @@ from astropy.stats import sigma_clip
 # Plot packages
 import matplotlib.pyplot as plt
 from matplotlib.ticker import AutoMinorLocator
+from matplotlib.collections import LineCollection
 plt.rc('xtick', direction='in', top='on')
 #plt.rc('xtick.minor', visible=True)
 plt.rc('ytick', direction='in', right='on')
 #plt.rc('ytick.minor', visible=True)
 
+# Constants evaluated once at import
+_C_KMS = cte.c/1000                     # Speed of light [km/s]
+_SQRT2 = np.sqrt(2)
+_SQRTPI = np.sqrt(np.pi)
+_SQRT2PI = np.sqrt(2*np.pi)
+_FWHM_FACTOR = 2*np.sqrt(2*np.log(2))   # FWHM = _FWHM_FACTOR*sigma (~2.35482)
+
+# np.trapz was renamed to np.trapezoid in numpy 2.0 (and later removed)
+_trapz = getattr(np, 'trapezoid', None) or np.trapz
+
 
 class spec():
     def __init__(self, spectrum, SNR=None, rv0=0, offset=0, txt=False):
@@ -118,23 +132,19 @@ class spec():
         -------
         In addition to update the class with new data, it returns the wavelength and flux
         vectors together with the HJD.
+
+        Notes
+        -----
+        The content of the fits files is cached in memory (last 16 files read) and it is
+        read again if the modification time of the file changes. Call _readfits.cache_clear()
+        from the spec module to release the memory used by the cache.
         '''
 
-        # Retrieve the key values fron the fits header
-        hdu = fits.open(self.spectrum)  # Open the fits image file
-        header0 = hdu[0].header         # Read header of primary extension
+        # Retrieve the wavelenght, flux and header of the fits file (cached)
+        wave, flux, header0 = _readfits(self.spectrum, os.path.getmtime(self.spectrum))
 
         instrum = header0['INSTRUME']   # Instrument
-
-        lam0 = header0['CRVAL1']          # Get the wavelenght of the first pixel
         dlam = header0['CDELT1']          # Step of increase in wavelength
-        pix0 = header0['CRPIX1']        # Reference pixel (generally 1, FEROS -49)
-        spec_length = header0['NAXIS1'] # Length of the spectrum
-        # Alternatively use len(hdu[0].data[0]) (NOT/MERCATOR) or len(hdu[0].data)
-
-        # Correct Mercator CRVAL1 20101018-19:
-        if any(bad in self.spectrum for bad in ['_20101018_','_20101019_']) and lam0 == 3763.9375:
-            lam0 = 3763.61
 
         try: vbar = header0['I-VBAR'] # [km/s] Barycent. rv correction at midpoint
         #    vbar = header0['BVCOR']  # [km/s] Barycent. rv correction at midpoint | MERCATOR
@@ -159,35 +169,28 @@ class spec():
             width = 200
             print('\nWARNING: Width value %f is too large, setting it to 200. ' %width)
 
-        wave = lam0 + dlam*(np.arange(spec_length) - pix0 + 1)
-        if '_log' in self.spectrum:
-            wave = np.exp(wave)
-        elif helcorr == 'hel' and not instrum == 'FEROS':
-            wave = wave*(1 + 1000*vbar/cte.c)
+        if helcorr == 'hel' and not instrum == 'FEROS' and not '_log' in self.spectrum:
+            wave = wave*(1 + vbar/_C_KMS)
         # Those with log and those from FEROS are already corrected from helcorr
 
-        wave = wave*(1 - 1000*self.rv0/cte.c)
+        wave = wave*(1 - self.rv0/_C_KMS)
 
         wave = wave - self.offset
 
-        try:
-            flux = hdu[0].data[0]
-        except:
-            flux = hdu[0].data
-
         if lwl != None and rwl != None:
             if wave[0] > lwl+dlam or wave[-1] < rwl-dlam:
                 print('WARNING: Wavelenght limits outside spectrum wavelenght range.')
-            flux = flux[(wave >= lwl-width/2.) & (wave <= rwl+width/2.)]
-            wave = wave[(wave >= lwl-width/2.) & (wave <= rwl+width/2.)]
+            window = _window_slice(wave, lwl-width/2., rwl+width/2.)
+            flux = flux[window]
+            wave = wave[window]
+
+        flux = flux.copy() # The cached flux is read-only
 
         if '_log' in self.spectrum:
             self.dlam = (wave[-1]-wave[0])/(len(wave)-1)
         else:
             self.dlam = dlam
 
-        hdu.close()
-
         self.wave_0 = wave
         self.flux_0 = flux
 
@@ -216,7 +219,7 @@ class spec():
             wave = np.asarray(data['col1'])
             flux = np.asarray(data['col2'])
 
-        wave = wave*(1 - 1000*self.rv0/cte.c)
+        wave = wave*(1 - self.rv0/_C_KMS)
 
         wave = wave - self.offset
 
@@ -224,8 +227,9 @@ class spec():
             dlam = (wave[-1]-wave[0])/(len(wave)-1)
             if wave[0] > lwl+dlam or wave[-1] < rwl-dlam:
                 print('WARNING: Wavelenght limits outside spectrum wavelenght range.')
-            flux = flux[(wave >= lwl-width/2.) & (wave <= rwl+width/2.)]
-            wave = wave[(wave >= lwl-width/2.) & (wave <= rwl+width/2.)]
+            window = _window_slice(wave, lwl-width/2., rwl+width/2.)
+            flux = flux[window]
+            wave = wave[window]
 
         self.dlam = (wave[-1]-wave[0])/len(wave)
         self.vbar = 0
@@ -300,7 +304,7 @@ class spec():
         dlamb = line/self.resolution
 
         # Maximum shift between the minimum of the fitted line and the tabulated value
-        tol_aa = float(tol)*(line)*1000/cte.c  # Changes km/s to angstroms
+        tol_aa = float(tol)*(line)/_C_KMS  # Changes km/s to angstroms
 
         # Maximum FWHM allowed (should be up to 18 for H lines)
         FWHM_max = 17
@@ -313,21 +317,25 @@ class spec():
                   'vr': ('A','lam0','sigma','gamma','vsini','y'),
                  'vrg': ('A','lam0','sigma','gamma','vsini','A2','sigma2','y')}
 
+        # Analytical jacobian used by curve_fit when available, otherwise it is
+        # estimated numerically
+        jac = None
+
         # Fitting function: Gaussian | A,lam0,sig
         if func == 'g':
-            fitfunc = f_gaussian1
+            fitfunc = f_gaussian1; jac = jac_gaussian1
             bounds  = ([-1,line-tol_aa,0],
                        [ 0,line+tol_aa,6])
 
         # Fitting function: Lorentzian | A,lam0,gamma,y
         elif func == 'l':
-            fitfunc = f_lorentzian
+            fitfunc = f_lorentzian; jac = jac_lorentzian
             bounds  = ([-1,line-tol_aa, 0,1. ],
                        [ 0,line+tol_aa,10,1.01])
 
         # Fitting function: Voigt profile | A,lam0,sigma,gamma,y
         elif func == 'v':
-            fitfunc = f_voigt
+            fitfunc = f_voigt; jac = jac_voigt
             bounds  = ([-10,line-tol_aa,0. ,0. ,1.  ], #'A' ~15 for As
                        [  0,line+tol_aa,7.5,8.5,1.01])
 
@@ -363,41 +371,33 @@ class spec():
         while i < iter:
 
             # Extracting the window of the spectrum
-            window = (self.wave >= line-width_i/2) & (self.wave <= line+width_i/2)
-            if not any(window):
+            window_i = _window_slice(self.wave, line-width_i/2, line+width_i/2)
+
+            flux = self.flux[window_i]
+            wave = self.wave[window_i]
+            if len(wave) == 0:
                 print('Line %sA not in spectra.\n' % line)
                 return fitsol
 
-            flux = self.flux[window]
-            wave = self.wave[window]
-
             dlam_mean = (wave[-1]-wave[0])/(len(wave)-1)
             # Auto-resampling
             #if dlam_mean >= 0.025 and not 'log' in star.filename:
             #    factor = dlam_mean/0.025; star.resamp(factor)
 
             # Find regions of the continuum to use during normalization (4 iter)
-            for j in range(4):
-                if j == 0:
-                    mask_i = ~np.isnan(flux)
-                else:
-                    mask_i = ~sigma_clip(flux/continuum_i, maxiters=None,
-                        sigma_lower=1.4, sigma_upper=2.5, axis=-1).mask #1.4 before
-
-                c_fit = np.poly1d(np.polyfit(wave[mask_i], flux[mask_i], 1))
-                continuum_i = c_fit(wave)
+            continuum_i,mask_i = _continuum(wave, flux)
 
             # Final normalization of the iteration
             flux_norm_i = flux / continuum_i
 
             #========================= Fitting the line ========================
             try:
-                popt_i = curve_fit(fitfunc, wave, flux_norm_i, bounds=bounds)[0]
+                popt_i = curve_fit(fitfunc, wave, flux_norm_i, bounds=bounds, jac=jac)[0]
                 flux_fit_i = fitfunc(wave, *popt_i)
 
                 # Calculate the empirical approximate FWHM
-                medval = (max(flux_fit_i) + min(flux_fit_i))/2
-                medpos = [np.where(flux_fit_i <= medval)[0][value] for value in (0,-1)]
+                medval = (flux_fit_i.max() + flux_fit_i.min())/2
+                medpos = np.flatnonzero(flux_fit_i <= medval)[[0,-1]]
                 FWHM = round(wave[medpos[1]] - wave[medpos[0]],2)
 
                 # Checking step results
@@ -406,7 +406,7 @@ class spec():
                 FWHM_min = np.max([3*dlam_mean,3/4*dlamb])
                 if FWHM_min < FWHM < FWHM_max:
                     flux_norm = flux_norm_i; continuum = continuum_i; mask = mask_i
-                    flux_fit = flux_fit_i; popt = popt_i; width = width_i
+                    flux_fit = flux_fit_i; popt = popt_i; width = width_i; window = window_i
                     i = i + 1; width_i = FWHM*7
                 elif FWHM < FWHM_min:
                     print('WARNING: FWHM(%.1f) < minimum FWHM for %.3fA' % (FWHM,line))
@@ -418,24 +418,24 @@ class spec():
             except: break
 
         #======================== Checking final results =======================
-        window = (self.wave >= line-width/2.) & (self.wave <= line+width/2.)
-        flux = self.flux[window]
-        wave = self.wave[window]
-
         if i == 0:
             if info is True:
                 print('Problem in spectrum %s' % self.filename)
                 print('Line %sA could not be fitted or does not exist.\n' % line)
             return fitsol
 
-        line_f = wave[flux_fit == min(flux_fit)][0]
+        # Window of the last accepted iteration
+        flux = self.flux[window]
+        wave = self.wave[window]
+
+        line_f = wave[np.argmin(flux_fit)]
         if abs(line - line_f) > tol_aa:
             if info is True:
                 print('Line %sA found outside tolerance.\n' % line)
             return fitsol
 
         RV_A   = round((line_f - line), 3)
-        RV_kms = round(((line_f - line)/line)*cte.c/1000, 1) # max precision is 100 m/s
+        RV_kms = round(((line_f - line)/line)*_C_KMS, 1) # max precision is 100 m/s
         line_f = round(line_f, 3)
 
         if info is True:
@@ -444,13 +444,12 @@ class spec():
         #=========================== Calculate the EW ==========================
         # stackoverflow.com/questions/34075111/calculate-equivalent-width-using-python-code
         # When emission is considered abs should be removed and 1-flux_fit -> flux_fit-1
-        EW = 0.5*abs(fsum((wave[wl-1] - wave[wl])*((1 - flux_fit[wl-1]) +
-             (1 - flux_fit[wl])) for wl in range(1, len(flux_fit))))
+        EW = abs(_trapz(1 - flux_fit, wave))
         EW = round(1000*EW)
 
         #====================== Calculate the final FWHM =======================
-        medval = (max(flux_fit) + min(flux_fit))/2
-        medpos = [np.where(flux_fit <= medval)[0][value] for value in (0,-1)]
+        medval = (flux_fit.max() + flux_fit.min())/2
+        medpos = np.flatnonzero(flux_fit <= medval)[[0,-1]]
         try:
             l_val = np.interp(medval, [flux_fit[medpos[0]], flux_fit[medpos[0]-1]],
                 [wave[medpos[0]], wave[medpos[0]-1]])
@@ -464,14 +463,15 @@ class spec():
         FWHM = round(r_val - l_val, 2)
 
         #======================= Calculate the line depth ======================
-        depth = round(1 - min(flux_fit), 2)
+        depth = round(1 - flux_fit.min(), 2)
 
         #===================== Calculate the SNR continuum =====================
         sigma_cont = np.std(flux_norm[mask])
         snr = int(1/sigma_cont)
 
         #============================= Quality value ===========================
-        q_fit = 1/np.std(flux_norm[flux_fit<.995]/flux_fit[flux_fit<.995]) #simple
+        in_line = flux_fit < .995
+        q_fit = 1/np.std(flux_norm[in_line]/flux_fit[in_line]) #simple
         q_fit = round(q_fit, 3)
 
         #================================ Plot =================================
@@ -542,23 +542,21 @@ class spec():
         '''
 
         if zone in ['b','B']:
-            mask = (self.wave > 4000) & (self.wave < 5000)
+            mask = _window_slice(self.wave, 4000, 5000, closed=False)
         elif zone in ['v','V']:
-            mask = (self.wave > 5000) & (self.wave < 6000)
+            mask = _window_slice(self.wave, 5000, 6000, closed=False)
         elif zone in ['r','R']:
-            mask = (self.wave > 6000) & (self.wave < 7000)
+            mask = _window_slice(self.wave, 6000, 7000, closed=False)
         elif zone in ['all','ALL']:
-            mask = (self.wave > 4000) & (self.wave < 7000)
+            mask = _window_slice(self.wave, 4000, 7000, closed=False)
 
         lambda0 = np.mean(self.wave[mask])
         resol = 10000
 
-        sigma = lambda0/(2.35482*float(resol))
+        sigma = lambda0/(_FWHM_FACTOR*float(resol))
 
-        gauss = f_gaussian(np.arange(-5*sigma, 5*sigma, self.dlam), sigma)
-        kernel = gauss/np.trapz(gauss)
-
-        convoluted = 1 + convolve(self.flux[mask] - 1, kernel, mode='same')
+        convoluted = 1 + _gaussconvolve(self.flux[mask] - 1, sigma, self.dlam,
+            mode='reflect')
 
         flux_norm = self.flux[mask]/convoluted
 
@@ -566,11 +564,11 @@ class spec():
         for gap in findlist('snr_gaps.txt'):
             lwl,rwl = [float(i) for i in gap.split('-')]
 
-            flux_norm_i = flux_norm[(self.wave[mask] >= lwl) & (self.wave[mask] <= rwl)]
+            flux_norm_i = flux_norm[_window_slice(self.wave[mask], lwl, rwl)]
 
             sig_clip = 3
             std = np.std(flux_norm_i)
-            flux_clean = np.where(abs(flux_norm_i - 1) > sig_clip*std, np.nan, flux_norm_i)
+            flux_clean = flux_norm_i[~(np.abs(flux_norm_i - 1) > sig_clip*std)]
 
             snr_all.append(1/np.nanstd(flux_clean))
 
@@ -608,7 +606,7 @@ class spec():
             # www.towardsdatascience.com/removing-spikes-from-raman-spectra-8a9fdda0ac22
 
             # First we calculated (nabla)x(i):
-            delta_flux = [self.flux[i+1] - self.flux[i] for i in np.arange(len(self.flux) - 1)]
+            delta_flux = np.diff(self.flux)
 
             median_int = np.median(delta_flux)
             mad_int = np.median([np.abs(delta_flux - median_int)])
@@ -622,27 +620,27 @@ class spec():
             if sig_g == None:
                 lambda0 = np.mean(self.wave)
                 # Two times the theoretical sigma offers better results
-                sigma = 2*lambda0/(2.35482*float(self.resolution))
+                sigma = 2*lambda0/(_FWHM_FACTOR*float(self.resolution))
             else:
                 sig_g = float(sig_g)
 
-            x = np.arange(-5*sigma, 5*sigma + self.dlam, self.dlam)
-            gauss = f_gaussian(x,sigma)
-            kernel = gauss/np.trapz(gauss)
-
-            convoluted = 1 + convolve(self.flux - 1, kernel, mode='same')
+            convoluted = 1 + _gaussconvolve(self.flux - 1, sigma, self.dlam, mode='reflect')
 
             flux_norm = self.flux/convoluted
 
+        # Rejected pixels are tracked in a mask instead of rewriting flux_norm
+        dev = np.abs(flux_norm - 1)
+        keep = ~np.isnan(flux_norm)
         for i in range(iter):
-            std = np.nanstd(flux_norm)
-            flux_norm = np.where(abs(flux_norm - 1) > sigclip*std, np.nan, flux_norm)
+            std = np.std(flux_norm[keep])
+            keep &= ~(dev > sigclip*std)
 
-        flux_clean = np.where(np.isnan(flux_norm), np.nan, self.flux)
+        flux_clean = np.where(keep, self.flux, np.nan)
 
-        nans = np.isnan(flux_clean)
-        x = lambda z: z.nonzero()[0]
-        flux_clean[nans] = np.interp(x(nans), x(~nans), flux_clean[~nans])
+        # Linear interpolation over the removed pixels
+        nans = np.isnan(flux_clean); good = ~nans
+        idx = np.arange(len(flux_clean))
+        flux_clean[nans] = np.interp(idx[nans], idx[good], flux_clean[good])
 
         flux_clean = np.where((flux_clean > self.flux) | (abs(flux_clean-self.flux) < 0.05),
             self.flux,flux_clean)
@@ -694,19 +692,17 @@ class spec():
         lambda0 = np.mean(self.wave)
 
         if profile == 'g' and (vsini==None and vmac==None):
-            sigma = lambda0/(2.35482*float(resol))
+            sigma = lambda0/(_FWHM_FACTOR*float(resol))
 
-            x = np.arange(-10*sigma, 10*sigma+self.dlam, self.dlam)
-            gauss = f_gaussian(x,sigma)
-            kernel = gauss/np.trapz(gauss)
+            convoluted = 1 + _gaussconvolve(self.flux - 1, sigma, self.dlam, halfwidth=10)
             self.resolution = resol
 
         elif profile == 'rotmac' and (vsini!=None and vmac!=None):
             x = np.arange(-9, 9+self.dlam, self.dlam)
             rotmac = f_rotmac(x, lambda0, vsini, vmac)
-            kernel = rotmac/np.trapz(rotmac)
+            kernel = rotmac/_trapz(rotmac)
 
-        convoluted = 1 + convolve(self.flux - 1, kernel, mode='same')
+            convoluted = 1 + _convolve(self.flux - 1, kernel)
 
         self.flux = convoluted
 
@@ -753,9 +749,24 @@ class spec():
             lwl = self.wave[0]
             rwl = self.wave[-1]
 
-        f = interp1d(self.wave, self.flux, kind=method, fill_value='extrapolate')
-        self.wave = np.arange(lwl, rwl+self.dlam, self.dlam)
-        self.flux = f(self.wave)
+        wave = np.arange(lwl, rwl+self.dlam, self.dlam)
+
+        if method == 'linear' and np.all(np.diff(self.wave) > 0):
+            # np.interp is much faster than interp1d for the linear case
+            flux = np.interp(wave, self.wave, self.flux)
+
+            # Linear extrapolation outside the original range as interp1d does
+            l = wave < self.wave[0]; r = wave > self.wave[-1]
+            flux[l] = self.flux[0] + (wave[l] - self.wave[0])*\
+                (self.flux[1] - self.flux[0])/(self.wave[1] - self.wave[0])
+            flux[r] = self.flux[-1] + (wave[r] - self.wave[-1])*\
+                (self.flux[-1] - self.flux[-2])/(self.wave[-1] - self.wave[-2])
+        else:
+            f = interp1d(self.wave, self.flux, kind=method, fill_value='extrapolate')
+            flux = f(wave)
+
+        self.wave = wave
+        self.flux = flux
 
         return None
 
@@ -819,7 +830,7 @@ class spec():
 
         for line,element,nplot in zip(lines, elements, range(len(lines))):
 
-            mask = (self.wave > line - width/2) & (self.wave < line + width/2)
+            mask = _window_slice(self.wave, line - width/2, line + width/2, closed=False)
 
             if len(lines) > 1:
                 plt.subplot(nrows, ncols, nplot + 1)
@@ -880,7 +891,7 @@ class spec():
         if rwl > max(self.wave):
             rwl = max(self.wave)
 
-        mask = (self.wave > lwl) & (self.wave < rwl)
+        mask = _window_slice(self.wave, lwl, rwl, closed=False)
 
         if lines != None:
 
@@ -914,15 +925,20 @@ class spec():
             at_color = {'HI':'gray', 'HeI':'turquoise', 'OI':'r', 'NI':'b', 'CI':'k', 'SI':'gold',
                 'Si':'tan', 'Mg':'g', 'Fe':'chocolate', 'Ne':'teal', 'Al':'rosybrown'}
 
-            for line in table:
-                try: c = at_color[line['spc'].replace(' ','')[:2]]
-                except: c = 'dimgray'
+            colors = [at_color.get(spc.replace(' ','')[:2], 'dimgray') for spc in table['spc']]
+
+            # All the lines are drawn as a single collection of vertical segments
+            segments = np.zeros((len(table), 2, 2))
+            segments[:,:,0] = np.asarray(table['wl_air'])[:,None]
+            segments[:,0,1] = 1.008-depth
+            segments[:,1,1] = np.median(self.flux[mask])
 
-                plt.plot([line['wl_air'],line['wl_air']], [1.008-depth,np.median(self.flux[mask])],
-                c=c, linestyle='dotted', lw=line['width'])
+            plt.gca().add_collection(LineCollection(segments, colors=colors,
+                linestyles='dotted', linewidths=np.asarray(table['width'])))
 
+            for wl,spc,c in zip(table['wl_air'], table['spc'], colors):
                 # depth line mask = depth deepest line
-                plt.text(line['wl_air'],1-depth, line['spc'], c=c, size=6, rotation=-90, clip_on=True)
+                plt.text(wl, 1-depth, spc, c=c, size=6, rotation=-90, clip_on=True)
 
         plt.plot(self.wave[mask], self.flux[mask], lw=.3, label=self.id_star+' '+self.SpC)
         plt.tick_params(direction='in', top='on')
@@ -940,6 +956,65 @@ class spec():
         return None
 
 
+# Functions to run some of the spec methods over many spectra in parallel:
+
+def batch_cosmic(spectra, max_workers=None, **kwargs):
+
+    '''
+    Function to remove the cosmic rays of several spectra in parallel, using a pool
+    of threads. Most of the work (convolutions, statistics and interpolations) is
+    done by numpy/scipy releasing the GIL, so threads allow to use many cores.
+
+    Parameters
+    ----------
+    spectra : list
+        List of spec objects to clean. Each one owns its arrays, which are updated.
+
+    max_workers : int, optional
+        Maximum number of threads. Default is the ThreadPoolExecutor default.
+
+    Other parameters : optional
+        See help for spec.cosmic
+
+    Returns
+    -------
+    Nothing, but the flux of each spectrum is replaced and cleaned from rays.
+    '''
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(lambda sp: sp.cosmic(**kwargs), spectra))
+
+    return None
+
+
+def batch_snrcalc(spectra, zone='v', max_workers=None):
+
+    '''
+    Function to calculate the Signal to Noise Ratio of several spectra in parallel,
+    using a pool of threads. See batch_cosmic.
+
+    Parameters
+    ----------
+    spectra : list
+        List of spec objects for which to calculate the SNR.
+
+    zone : str, optional
+        See help for spec.snrcalc
+
+    max_workers : int, optional
+        Maximum number of threads. Default is the ThreadPoolExecutor default.
+
+    Returns
+    -------
+    List with the measured signal-to-noise ratio of each spectrum.
+    '''
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        snrs = list(executor.map(lambda sp: sp.snrcalc(zone=zone), spectra))
+
+    return snrs
+
+
 # It now follows the functions describing the different fitting profiles:
 
 def f_gaussian(x, sigma):
@@ -955,76 +1030,389 @@ def f_lorentzian(x, A, lam0, gamma, y):
 def f_voigt(x, A, lam0, sigma, gamma, y):
     # sigma -> gaussian width; gamma -> lorentzian width
     # sigma = alpha / sqrt(2 * np.log(2))
-    return A*np.real(wofz((x - lam0 + 1j*gamma)/sigma/np.sqrt(2)))/sigma/np.sqrt(2*np.pi) + y
+    # Re[wofz((x - lam0 + 1j*gamma)/sigma/sqrt(2))]/sigma/sqrt(2*pi) = voigt_profile
+    return A*voigt_profile(x - lam0, sigma, gamma) + y
+
+# Analytical jacobians of the fitting profiles (used by curve_fit):
+
+def jac_gaussian1(x, A, lam0, sigma):
+    G = np.exp(-(x - lam0)**2/(2*sigma**2))
+    return np.stack((G, A*G*(x - lam0)/sigma**2, A*G*(x - lam0)**2/sigma**3), axis=-1)
+
+def jac_lorentzian(x, A, lam0, gamma, y):
+    D = (x - lam0)**2 + gamma**2
+    return np.stack((gamma**2/D, 2*A*gamma**2*(x - lam0)/D**2,
+        2*A*gamma*(x - lam0)**2/D**2, np.ones_like(x)), axis=-1)
+
+def jac_voigt(x, A, lam0, sigma, gamma, y):
+    # Derivative of the Faddeeva function: w'(z) = -2*z*w(z) + 2i/sqrt(pi)
+    z = (x - lam0 + 1j*gamma)/sigma/_SQRT2
+    w = wofz(z)
+    dw = -2*z*w + 2j/_SQRTPI
+    norm = 1/sigma/_SQRT2PI
+    return np.stack((norm*np.real(w), -A*norm*np.real(dw)/sigma/_SQRT2,
+        -A*norm*(np.real(dw*z) + np.real(w))/sigma, -A*norm*np.imag(dw)/sigma/_SQRT2,
+        np.ones_like(x)), axis=-1)
 
 def f_rot(x, A, lam0, sigma, vsini):
     G = A*np.exp(-(x - lam0)**2/(2*sigma**2))
 
     # Default value: beta=1.5 (epsilon=0.6) beta=epsilon/(1 - epsilon)
     eps = 0.6
-    delta = 1000*lam0*vsini/cte.c
-    doppl = 1 - ((x - lam0)/delta)**2
+    delta = lam0*vsini/_C_KMS
+    doppl = np.maximum(1 - ((x - lam0)/delta)**2, 0) # Zero outside the stellar disk
 
     R = A*(2*(1 - eps)*np.sqrt(doppl) + np.pi*eps/2.*doppl)/(np.pi*delta*(1 - eps/3))
-    R = np.nan_to_num(R)
 
-    return 1-convolve(G,R,mode='same')
+    return 1-_convolve(G, R)
 
 def f_voigtrot(x, A, lam0, sigma, gamma, vsini, y):
-    V = A*np.real(wofz((x-lam0+1j*gamma)/sigma/np.sqrt(2)))/sigma/np.sqrt(2*np.pi) + y
+    V = A*voigt_profile(x - lam0, sigma, gamma) + y
 
     eps = 0.6
-    delta = 1000*lam0*vsini/cte.c
-    doppl = 1 - ((x - lam0)/delta)**2
+    delta = lam0*vsini/_C_KMS
+    doppl = np.maximum(1 - ((x - lam0)/delta)**2, 0) # Zero outside the stellar disk
 
     R = A*(2*(1 - eps)*np.sqrt(doppl) + np.pi*eps/2.*doppl)/(np.pi*delta*(1 - eps/3))
-    R = np.nan_to_num(R)
 
-    return 1-convolve(V, R, mode='same')
+    return 1-_convolve(V, R)
 
 def f_vrg(x, A, lam0, sigma, gamma, vsini, A2, sigma2, y):
-    VG = A*np.real(wofz((x - lam0 + 1j*gamma)/sigma/np.sqrt(2)))/sigma/np.sqrt(2*np.pi) + y \
-        + A2*np.exp(-(x - lam0)**2/(2*sigma2**2))
+    VG = A*voigt_profile(x - lam0, sigma, gamma) + y + A2*np.exp(-(x - lam0)**2/(2*sigma2**2))
 
     eps = 0.6
-    delta = 1000*lam0*vsini/cte.c
-    doppl = 1 - ((x - lam0)/delta)**2
+    delta = lam0*vsini/_C_KMS
+    doppl = np.maximum(1 - ((x - lam0)/delta)**2, 0) # Zero outside the stellar disk
 
     R = A*(2*(1 - eps)*np.sqrt(doppl)+np.pi*eps/2.*doppl)/(np.pi*delta*(1 - eps/3))
-    R = np.nan_to_num(R)
 
-    return 1-convolve(VG, R, mode='same')
+    return 1-_convolve(VG, R)
 
 def f_rotmac(x, lam0, vsini=None, vmac=None):
 
     if vsini != None:
         # Rotational function:
-        delta_R = 1000*lam0*vsini/cte.c
-        doppl = 1 - (x/delta_R)**2
+        delta_R = lam0*vsini/_C_KMS
+        doppl = np.maximum(1 - (x/delta_R)**2, 0) # Zero outside the stellar disk
 
         eps = 0.6
         R = (2*(1 - eps)*np.sqrt(doppl) + np.pi*eps/2.*doppl)/(np.pi*delta_R*(1 - eps/3))
-        R = np.nan_to_num(R)
 
         if vmac == None:
             return R
 
     if vmac != None:
         # Macroturbulence function:
-        delta_M = 1000*lam0*vmac/cte.c
-        A = 2/np.sqrt(np.pi)/delta_M
+        delta_M = lam0*vmac/_C_KMS
+        A = 2/_SQRTPI/delta_M
 
         x_2 = x[len(x)//2:]
         x_d = x_2/delta_M
 
-        M_T = A*x_d*(-np.sqrt(np.pi)+np.exp(-x_d**2)/x_d+np.sqrt(np.pi)*erf(x_d))
+        # x_d*(-sqrt(pi) + exp(-x_d**2)/x_d + sqrt(pi)*erf(x_d)) without the division
+        M_T = A*(np.exp(-x_d**2) - _SQRTPI*x_d*erfc(x_d))
 
         M = M_T # + M_R
 
-        M = np.concatenate((M[::-1], M[1:]))
+        # Symmetric profile built from the positive half
+        n = len(M)
+        M_sym = np.empty(2*n - 1)
+        M_sym[n-1:] = M
+        M_sym[:n] = M[::-1]
+        M = M_sym
 
         if vsini == None:
             return M
 
     if vsini != None and vmac != None:
-        return convolve(R, M, mode='same')
+        return _convolve(R, M)
+
+
+# Auxiliary functions used internally by the spec class:
+
+def _window_slice(wave, lwl, rwl, closed=True):
+
+    '''
+    Function to select the region of a wavelenght vector between lwl and rwl, including
+    the limits if closed is True. For monotonically increasing wavelenghts it returns a
+    slice found by binary search, otherwise it falls back to a boolean mask.
+    '''
+
+    if len(wave) > 1 and wave[0] < wave[-1]:
+        if closed == True:
+            return slice(np.searchsorted(wave, lwl, side='left'),
+                         np.searchsorted(wave, rwl, side='right'))
+        else:
+            return slice(np.searchsorted(wave, lwl, side='right'),
+                         np.searchsorted(wave, rwl, side='left'))
+
+    if closed == True:
+        return (wave >= lwl) & (wave <= rwl)
+    else:
+        return (wave > lwl) & (wave < rwl)
+
+@lru_cache(maxsize=16)
+def _readfits(spectrum, mtime):
+
+    '''
+    Function to read the header and the data of a fits spectrum, keeping the result
+    in memory so that consecutive calls to spec.waveflux for the same file do not
+    need to open it again. The modification time of the file (mtime) is only used as
+    part of the key of the cache, so that modified files are read again.
+
+    Returns
+    -------
+    Read-only wavelenght (without any velocity correction) and flux (float32) vectors,
+    together with a dictionary with the primary header.
+    '''
+
+    # Retrieve the key values fron the fits header
+    with fits.open(spectrum) as hdu:
+        header0 = dict(hdu[0].header)   # Read header of primary extension
+
+        # Flux stored in native single precision, enough and lighter for all the
+        # operations. The wavelenght is kept in double precision as single precision
+        # is not enough for RV measurements (~4e-4A at 4000-8000A).
+        try:
+            flux = np.array(hdu[0].data[0], dtype=np.float32)
+        except:
+            flux = np.array(hdu[0].data, dtype=np.float32)
+
+    lam0 = header0['CRVAL1']          # Get the wavelenght of the first pixel
+    dlam = header0['CDELT1']          # Step of increase in wavelength
+    pix0 = header0['CRPIX1']        # Reference pixel (generally 1, FEROS -49)
+    spec_length = header0['NAXIS1'] # Length of the spectrum
+    # Alternatively use len(hdu[0].data[0]) (NOT/MERCATOR) or len(hdu[0].data)
+
+    # Correct Mercator CRVAL1 20101018-19:
+    if any(bad in spectrum for bad in ['_20101018_','_20101019_']) and lam0 == 3763.9375:
+        lam0 = 3763.61
+
+    wave = lam0 + dlam*(np.arange(spec_length) - pix0 + 1)
+    if '_log' in spectrum:
+        wave = np.exp(wave)
+
+    wave.setflags(write=False)
+    flux.setflags(write=False)
+
+    return wave, flux, header0
+
+def _convolve(in1, in2):
+
+    '''
+    Function to convolve a flux vector with a kernel returning the central part of
+    the convolution with the same size as the first input (i.e. mode='same').
+    The method is chosen depending on the length of the kernel: direct convolution
+    for short kernels, FFT for medium ones and overlap-add for long kernels.
+    '''
+
+    if len(in2) < 64 and len(in2) <= len(in1):
+        return np.convolve(in1, in2, mode='same')
+
+    # Double precision FFTs also for single precision (e.g. fits) fluxes
+    in1 = np.asarray(in1, dtype=float)
+
+    # FFT methods would spread any NaN to the whole output, so the NaNs are filled
+    # before and restored only where a direct convolution would have them
+    bad = ~np.isfinite(in1)
+    if bad.any():
+        in1 = _fill_nans(in1, bad)
+
+    if len(in2) > 500 and len(in1) > 2*len(in2):
+        conv = oaconvolve(in1, in2, mode='same')
+    else:
+        conv = fftconvolve(in1, in2, mode='same')
+
+    if bad.any():
+        conv[_nan_reach(bad, len(in2))] = np.nan
+
+    return conv
+
+def _fill_nans(flux, bad):
+
+    '''
+    Function to fill the non-finite values (bad) of a flux vector by linear
+    interpolation between the neighbouring valid pixels, as done in spec.cosmic.
+
+    Returns
+    -------
+    Copy of the flux vector with the non-finite values filled.
+    '''
+
+    flux = np.array(flux, dtype=float)
+    good = ~bad
+    if good.any():
+        idx = np.arange(len(flux))
+        flux[bad] = np.interp(idx[bad], idx[good], flux[good])
+
+    return flux
+
+def _nan_reach(bad, kernel_length):
+
+    '''
+    Function to find the pixels of the output of a convolution (mode='same') with a
+    kernel of a given length that are affected by the non-finite input pixels (bad).
+    '''
+
+    return _convolve(bad.astype(float), np.ones(kernel_length)) > 0.5
+
+
+def _continuum(wave, flux, sigma_lower=1.4, sigma_upper=2.5, iters=4):
+
+    '''
+    Function to iteratively fit a linear continuum to a spectral window, rejecting
+    at each iteration the points of the line by asymmetric sigma clipping.
+    It returns the continuum evaluated along the window and the mask of the points
+    used in the last fit.
+    '''
+
+    for j in range(iters):
+        if j == 0:
+            mask = ~np.isnan(flux)
+        else:
+            mask = _sigma_clip(flux/continuum, sigma_lower, sigma_upper) #1.4 before
+
+        slope,intercept = _linfit(wave[mask], flux[mask])
+        continuum = slope*wave + intercept
+
+    return continuum, mask
+
+def _sigma_clip(data, sigma_lower, sigma_upper):
+
+    '''
+    Function to iteratively clip a 1D vector around its median with asymmetric lower
+    and upper limits in units of its standard deviation, until no more points are
+    rejected. Equivalent to astropy sigma_clip with maxiters=None for 1D data.
+
+    Returns
+    -------
+    Boolean mask with True for the points that were not clipped.
+    '''
+
+    mask = np.isfinite(data)
+    n_mask = np.count_nonzero(mask)
+    while True:
+        values = data[mask]
+        median = np.median(values); std = np.std(values)
+
+        mask = mask & (data >= median - sigma_lower*std) & (data <= median + sigma_upper*std)
+
+        n_new = np.count_nonzero(mask)
+        if n_new == n_mask:
+            break
+        n_mask = n_new
+
+    # As in astropy, the final limits are applied to the full input, so points clipped
+    # in earlier iterations can be recovered
+    mask = np.isfinite(data) & (data >= median - sigma_lower*std) & \
+        (data <= median + sigma_upper*std)
+
+    return mask
+
+def _linfit(x, y):
+
+    '''
+    Function to fit a straight line by least squares using the closed-form solution of
+    the normal equations. Equivalent to np.polyfit(x, y, 1) but without its overhead.
+    The x vector is centered first to avoid losing precision with wavelenghts.
+
+    Returns
+    -------
+    Slope and intercept of the fitted line.
+    '''
+
+    x_mean = x.mean(); y_mean = y.mean()
+    dx = x - x_mean
+
+    slope = np.dot(dx, y - y_mean)/np.dot(dx, dx)
+    intercept = y_mean - slope*x_mean
+
+    return slope, intercept
+
+@lru_cache(maxsize=32)
+def _gauss_kernel(sigma, dx, halfwidth=5):
+
+    '''
+    Function to build a normalized gaussian kernel sampled every dx between -halfwidth
+    and +halfwidth times sigma. The kernel is cached and returned as read-only.
+    '''
+
+    x = np.arange(-halfwidth*sigma, halfwidth*sigma + dx, dx)
+    gauss = f_gaussian(x, sigma)
+    # Analytical integral of the gaussian truncated at +-halfwidth*sigma on a grid with
+    # step dx, only valid if the gaussian is well sampled, otherwise normalize numerically
+    if sigma/dx >= 1:
+        kernel = gauss*dx/(sigma*_SQRT2PI*erf(halfwidth/_SQRT2))
+    else:
+        kernel = gauss/gauss.sum()
+
+    kernel.setflags(write=False)
+
+    return kernel
+
+@lru_cache(maxsize=32)
+def _gauss_kernel_fft(sigma, dx, halfwidth, nfft):
+
+    '''
+    Function to compute and cache the real FFT of a gaussian kernel zero-padded to
+    nfft points. See _gauss_kernel.
+    '''
+
+    kernel_fft = rfft(_gauss_kernel(sigma, dx, halfwidth), nfft)
+
+    kernel_fft.setflags(write=False)
+
+    return kernel_fft
+
+def _gaussconvolve(flux, sigma, dx, halfwidth=5, mode='constant'):
+
+    '''
+    Function to convolve a flux vector with a normalized gaussian kernel of a given
+    sigma and step dx, returning an output with the same size as the input flux.
+    Both the kernel and its FFT are cached, so consecutive calls with the same sigma,
+    dx and length of the flux (e.g. batch processing at a fixed resolution) do not
+    need to compute them again.
+    The mode sets how the edges of the flux are extended with the same names used in
+    convolve1d: 'constant' (zeros, default), 'reflect', 'mirror', 'nearest' or 'wrap'.
+    '''
+
+    # Round sigma and dx to 6 significant figures to be used as keys of the cache
+    sigma = float('%.6g' % sigma); dx = float('%.6g' % dx)
+
+    kernel = _gauss_kernel(sigma, dx, halfwidth)
+
+    # Extend the edges explicitly so that all the methods below treat them equally
+    pad = 0
+    if mode != 'constant':
+        pad_modes = {'reflect':'symmetric', 'mirror':'reflect', 'nearest':'edge',
+            'wrap':'wrap'}
+        pad = len(kernel)//2 + 1
+        flux = np.pad(flux, pad, mode=pad_modes[mode])
+
+    if len(kernel) > len(flux):
+        conv = _convolve(flux, kernel)
+    elif len(kernel) < 64:
+        # Even kernels need origin=-1 to be centered as in mode='same'
+        conv = convolve1d(flux, kernel, output=float, mode='constant',
+            origin=-1 if len(kernel)%2 == 0 else 0)
+    else:
+        # The FFT is done in double precision as the cached kernel FFT, since scipy.fft
+        # would transform single precision (e.g. fits) fluxes in complex64
+        flux = np.asarray(flux, dtype=float)
+
+        # NaNs are filled and restored afterwards as in _convolve
+        bad = ~np.isfinite(flux)
+        if bad.any():
+            flux = _fill_nans(flux, bad)
+
+        n = len(flux) + len(kernel) - 1
+        nfft = next_fast_len(n, real=True)
+        conv = irfft(rfft(flux, nfft)*_gauss_kernel_fft(sigma, dx, halfwidth, nfft), nfft)
+
+        i0 = (len(kernel) - 1)//2
+        conv = conv[i0:i0 + len(flux)]
+
+        if bad.any():
+            conv[_nan_reach(bad, len(kernel))] = np.nan
+
+    return conv[pad:len(conv) - pad]